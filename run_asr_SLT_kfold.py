@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
+import argparse
+import json
 import logging
+import math
+import os
 import pathlib
 import re
 import pandas as pd
 import sys
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional, Set, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Union
 import pickle as pkl
 
 import datasets
@@ -14,7 +18,8 @@ import torch
 import torch.nn as nn
 from packaging import version
 
-import librosa
+import soundfile as sf
+import torchaudio
 from scipy.io import wavfile
 from transformers import (
     HfArgumentParser,
@@ -27,16 +32,32 @@ from transformers import (
     is_apex_available,
     trainer_utils,
 )
+from transformers.hf_argparser import string_to_bool
+from transformers.utils import is_torch_tf32_available
 
 if is_apex_available():
     from apex import amp
 
-if version.parse(torch.__version__) >= version.parse("1.6"):
-    _is_native_cuda_amp_available = True
-    from torch.cuda.amp import autocast
-
 logger = logging.getLogger(__name__)
 
+_resamplers: Dict[int, torchaudio.transforms.Resample] = {}
+
+
+def load_speech(path: str, target_sr: int = 16000) -> np.ndarray:
+    """
+    Reads an audio file as a mono float32 waveform sampled at ``target_sr``.
+
+    Resamplers are built once per source sampling rate and reused across calls.
+    """
+    speech, sr = sf.read(path, dtype="float32", always_2d=False)
+    if speech.ndim == 2:
+        speech = speech.mean(axis=1)
+    if sr != target_sr:
+        if sr not in _resamplers:
+            _resamplers[sr] = torchaudio.transforms.Resample(sr, target_sr)
+        speech = _resamplers[sr](torch.from_numpy(speech)).numpy()
+    return speech
+
 
 @dataclass
 class ModelArguments:
@@ -79,6 +100,23 @@ def configure_logger(model_args: ModelArguments, training_args: TrainingArgument
     logger.setLevel(logging_level)
 
 
+def make_vocabulary_text_cleaner(tokenizer: Wav2Vec2CTCTokenizer) -> Callable[[str], str]:
+    """
+    Returns a function that removes the characters of a text that are not in the tokenizer's vocabulary, keeping
+    whitespace. Characters are matched regardless of case if the tokenizer lowercases its input.
+    """
+    allowed_chars = {t for t in tokenizer.get_vocab().keys() if len(t) == 1}
+    if tokenizer.do_lower_case:
+        allowed_chars |= {c for t in allowed_chars for c in (
+            t.lower(), t.upper()) if len(c) == 1}
+    allowed_chars = frozenset(allowed_chars)
+
+    def clean(text: str) -> str:
+        return "".join(c for c in text if c in allowed_chars or c.isspace())
+
+    return clean
+
+
 @dataclass
 class DataTrainingArguments:
     """
@@ -130,6 +168,21 @@ class DataTrainingArguments:
         default=None,
         metadata={"help": "The number of processes to use for the preprocessing."},
     )
+    preprocessed_dataset_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Where to save the preprocessed dataset, and load it from on later runs unless `overwrite_cache` is set."},
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={
+            "help": "Decode audio on the fly in the dataloader workers instead of preprocessing and caching the whole dataset."},
+    )
+    parallel_folds: bool = field(
+        default=False,
+        metadata={
+            "help": "Train one fold per process on its own GPU when launched with `torchrun --nproc_per_node=<n_folds>`, instead of DDP."},
+    )
 
 
 @dataclass
@@ -156,6 +209,13 @@ class Orthography:
     translation_table: Optional[Dict[str, str]] = field(default_factory=dict)
     words_to_remove: Optional[Set[str]] = field(default_factory=set)
 
+    # matches whatever `" ".join(text.split())` would change
+    _unclean_whitespace = re.compile(r"[^\S ]|  |^ | $")
+
+    def __post_init__(self):
+        self._needs_translate = bool(self.translation_table)
+        self._needs_remove = bool(self.words_to_remove)
+
     @classmethod
     def from_name(cls, name: str):
         if name == "librispeech":
@@ -179,9 +239,11 @@ class Orthography:
         raise ValueError(f"Unsupported orthography: '{name}'.")
 
     def preprocess_for_training(self, text: str) -> str:
-        if len(self.translation_table) > 0:
+        if not self._needs_translate and not self._needs_remove and not self._unclean_whitespace.search(text):
+            return text
+        if self._needs_translate:
             text = text.translate(self.translation_table)
-        if len(self.words_to_remove) == 0:
+        if not self._needs_remove:
             text = " ".join(text.split())  # clean up whilespaces
         else:
             # and clean up whilespaces
@@ -234,6 +296,10 @@ class DataCollatorCTCWithPadding:
             If set will pad the sequence to a multiple of the provided value.
             This is especially useful to enable the use of Tensor Cores on NVIDIA hardware with compute capability >=
             7.5 (Volta).
+
+    The ``input_values`` of the features are expected to be raw 16-bit PCM waveforms; they are scaled to [-1, 1] and
+    zero-mean unit-variance normalized here (if the feature extractor is configured to) instead of during dataset
+    preprocessing.
     """
 
     processor: Wav2Vec2Processor
@@ -243,29 +309,36 @@ class DataCollatorCTCWithPadding:
     pad_to_multiple_of: Optional[int] = None
     pad_to_multiple_of_labels: Optional[int] = None
 
+    def normalize(self, input_values: Union[List[int], np.ndarray]) -> np.ndarray:
+        input_values = np.asarray(input_values, dtype=np.float32) / 32768.0
+        if self.processor.feature_extractor.do_normalize:
+            # same per-utterance normalization as Wav2Vec2FeatureExtractor, applied before padding
+            input_values = (input_values - input_values.mean()) / \
+                np.sqrt(input_values.var() + 1e-7)
+        return input_values
+
     def __call__(self, features: List[Dict[str, Union[List[int], torch.Tensor]]]) -> Dict[str, torch.Tensor]:
         # split inputs and labels since they have to be of different lenghts and need
         # different padding methods
-        input_features = [{"input_values": feature["input_values"]}
-                          for feature in features]
-        label_features = [{"input_ids": feature["labels"]}
-                          for feature in features]
+        input_features = {"input_values": [self.normalize(feature["input_values"])
+                                           for feature in features]}
+        label_features = {"input_ids": [feature["labels"]
+                                        for feature in features]}
 
-        batch = self.processor.pad(
+        batch = self.processor.feature_extractor.pad(
             input_features,
             padding=self.padding,
             max_length=self.max_length,
             pad_to_multiple_of=self.pad_to_multiple_of,
             return_tensors="pt",
         )
-        with self.processor.as_target_processor():
-            labels_batch = self.processor.pad(
-                label_features,
-                padding=self.padding,
-                max_length=self.max_length_labels,
-                pad_to_multiple_of=self.pad_to_multiple_of_labels,
-                return_tensors="pt",
-            )
+        labels_batch = self.processor.tokenizer.pad(
+            label_features,
+            padding=self.padding,
+            max_length=self.max_length_labels,
+            pad_to_multiple_of=self.pad_to_multiple_of_labels,
+            return_tensors="pt",
+        )
 
         # replace padding with -100 to ignore loss correctly
         labels = labels_batch["input_ids"].masked_fill(
@@ -277,6 +350,19 @@ class DataCollatorCTCWithPadding:
 
 
 class CTCTrainer(Trainer):
+    def create_optimizer(self):
+        """
+        Same as :meth:`Trainer.create_optimizer`, and checks that frozen parameters were left out of the optimizer, so
+        that no optimizer state is allocated for them.
+        """
+        optimizer = super().create_optimizer()
+        frozen_parameters = {id(param) for param in self.model.parameters()
+                             if not param.requires_grad}
+        assert not any(
+            id(param) in frozen_parameters for group in optimizer.param_groups for param in group["params"]
+        ), "Frozen parameters must not be passed to the optimizer."
+        return optimizer
+
     def training_step(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]]) -> torch.Tensor:
         """
         Perform a training step on a batch of inputs.
@@ -299,25 +385,14 @@ class CTCTrainer(Trainer):
         model.train()
         inputs = self._prepare_inputs(inputs)
 
-        if self.use_cuda_amp:
-            with autocast():
-                loss = self.compute_loss(model, inputs)
-        else:
+        # fp16 / bf16 autocast as configured in the training arguments
+        with self.autocast_smart_context_manager():
             loss = self.compute_loss(model, inputs)
 
-        if self.args.n_gpu > 1:
-            if model.module.config.ctc_loss_reduction == "mean":
-                loss = loss.mean()
-            elif model.module.config.ctc_loss_reduction == "sum":
-                loss = loss.sum() / (inputs["labels"] >= 0).sum()
-            else:
-                raise ValueError(
-                    f"{model.config.ctc_loss_reduction} is not valid. Choose one of ['mean', 'sum']")
-
         if self.args.gradient_accumulation_steps > 1:
             loss = loss / self.args.gradient_accumulation_steps
 
-        if self.use_cuda_amp:
+        if self.do_grad_scaling:
             self.scaler.scale(loss).backward()
         elif self.use_apex:
             with amp.scale_loss(loss, self.optimizer) as scaled_loss:
@@ -330,15 +405,72 @@ class CTCTrainer(Trainer):
         return loss.detach()
 
 
+def preprocess_logits_for_metrics(logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    """
+    Reduces the CTC logits to predicted token ids on the device, so that only the ids are gathered for
+    :obj:`compute_metrics` instead of the full logits.
+    """
+    if isinstance(logits, tuple):
+        logits = logits[0]
+    return logits.argmax(dim=-1).to(torch.int16)
+
+
 def main():
+    k = 4
+    folds = range(2, k)
+    fold_rank = None
+    if HfArgumentParser(DataTrainingArguments, add_help=False, allow_abbrev=False).parse_known_args()[0].parallel_folds:
+        if "LOCAL_RANK" not in os.environ or int(os.environ.get("WORLD_SIZE", 1)) != len(folds):
+            raise ValueError(
+                f"--parallel_folds trains one fold per process. Launch it with "
+                f"`torchrun --nproc_per_node={len(folds)} run_asr_SLT_kfold.py --parallel_folds ...` "
+                f"to train folds {list(folds)}."
+            )
+        # Each process trains its own fold. Hide the torchrun environment from TrainingArguments, which would
+        # otherwise set up DDP across the folds, and give each process only its own GPU.
+        fold_rank = int(os.environ.pop("LOCAL_RANK"))
+        for name in ("RANK", "WORLD_SIZE", "LOCAL_WORLD_SIZE"):
+            os.environ.pop(name, None)
+        visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+        os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices.split(
+            ",")[fold_rank] if visible_devices else str(fold_rank)
+
+    fp16_parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    fp16_parser.add_argument("--fp16", type=string_to_bool,
+                             nargs="?", const=True, default=False)
+    fp16_requested = fp16_parser.parse_known_args()[0].fp16
 
     parser = HfArgumentParser(
         (ModelArguments, DataTrainingArguments, TrainingArguments))
+    parser.set_defaults(
+        ddp_bucket_cap_mb=50,
+        # batch utterances of similar duration to cut down on padding
+        group_by_length=True,
+        length_column_name="duration_in_seconds",
+        dataloader_num_workers=4,
+        dataloader_pin_memory=True,
+        eval_accumulation_steps=32,
+        torch_compile=version.parse(torch.__version__) >= version.parse("2.0"),
+        ddp_broadcast_buffers=False,
+        tf32=is_torch_tf32_available(),
+        # bf16 needs no loss scaling; it is not the default for `--fp16` runs, and `--bf16 False` trains in fp32
+        bf16=torch.cuda.is_available() and torch.cuda.is_bf16_supported() and not fp16_requested,
+    )
 
     model_args, data_args, training_args = parser.parse_args_into_dataclasses()
     configure_logger(model_args, training_args)
-    print("data_args.preprocessing_num_workers",
-          data_args.preprocessing_num_workers)
+    if training_args.n_gpu > 1:
+        raise ValueError(
+            f"Found {training_args.n_gpu} GPUs in a single process. Launch with "
+            "`torchrun --nproc_per_node=<n_gpus> run_asr_SLT_kfold.py ...` to train with DistributedDataParallel."
+        )
+    if fold_rank is not None and data_args.preprocessed_dataset_dir is not None:
+        # the fold processes do not synchronize, so each one keeps its own copy
+        data_args.preprocessed_dataset_dir += f"_rank_{fold_rank}"
+    is_main_process = trainer_utils.is_main_process(training_args.local_rank)
+    if is_main_process:
+        print("data_args.preprocessing_num_workers",
+              data_args.preprocessing_num_workers)
     use_ft_vocab = True
     lang = "fi"
     if lang == "fi":
@@ -353,116 +485,210 @@ def main():
         df.columns = ['file', 'split', 'text']
 
     orthography = Orthography.from_name(data_args.orthography.lower())
-    k = 4
-    for i in range(2, k):
-        print(f"Fold {i}")
-
-        if use_ft_vocab:
-            # Use fine-tuned model, don't remove LM head
-            if lang == "fi":
-                pretrained_fi = "/scratch/elec/puhe/p/getmany1/wav2vec2_large_14.2k_fi_donatespeech_100h_SEGMENTED_13042022_60ep/checkpoint-11100"
-                processor = Wav2Vec2Processor.from_pretrained(
-                    pretrained_fi, cache_dir=model_args.cache_dir)
-            elif lang == "sv":
-                processor = Wav2Vec2Processor.from_pretrained(
-                    model_args.model_name_or_path, cache_dir=model_args.cache_dir)
-            model = Wav2Vec2ForCTC.from_pretrained(model_args.model_name_or_path, cache_dir=model_args.cache_dir,
-                                                   pad_token_id=processor.tokenizer.pad_token_id, vocab_size=len(processor.tokenizer))
-
-        train_dataset = datasets.Dataset.from_pandas(df[df.split != i])
-        val_dataset = datasets.Dataset.from_pandas(df[df.split == i])
-
-        wer_metric = datasets.load_metric("wer")
-        cer_metric = datasets.load_metric("cer")
-
-        target_sr = processor.feature_extractor.sampling_rate if data_args.target_feature_extractor_sampling_rate else None
-        vocabulary_chars_str = "".join(
-            t for t in processor.tokenizer.get_vocab().keys() if len(t) == 1)
-        vocabulary_text_cleaner = re.compile(  # remove characters not in vocabulary
-            # allow space in addition to chars in vocabulary
-            f"[^\s{re.escape(vocabulary_chars_str)}]",
-            flags=re.IGNORECASE if processor.tokenizer.do_lower_case else 0,
-        )
-        text_updates = []
-
-        def prepare_example(example):
-            example["speech"], example["sampling_rate"] = librosa.load(
-                example["file"], sr=16000)
-
-            example["duration_in_seconds"] = len(example["speech"]) / target_sr
-            updated_text = orthography.preprocess_for_training(example["text"])
-            updated_text = vocabulary_text_cleaner.sub("", updated_text)
-            if updated_text != example["text"]:
-                text_updates.append((example["text"], updated_text))
-                example["text"] = updated_text
-            return example
-
-        train_dataset = train_dataset.map(
-            prepare_example, remove_columns=["file", "split"])
-        val_dataset = val_dataset.map(
-            prepare_example, remove_columns=["file", "split"])
-
-        if data_args.max_duration_in_seconds is not None:
-
-            def filter_by_max_duration(example):
-                return example["duration_in_seconds"] <= data_args.max_duration_in_seconds
-
-            old_train_size = len(train_dataset)
-            old_val_size = len(val_dataset)
-            train_dataset = train_dataset.filter(filter_by_max_duration)
-            val_dataset = val_dataset.filter(filter_by_max_duration)
-            if len(train_dataset) > old_train_size:
-                logger.warning(
-                    f"Filtered out {len(train_dataset) - old_train_size} train example(s) longer than {data_args.max_duration_in_seconds} second(s)."
-                )
-            if len(val_dataset) > old_val_size:
-                logger.warning(
-                    f"Filtered out {len(val_dataset) - old_val_size} validation example(s) longer than {data_args.max_duration_in_seconds} second(s)."
-                )
-        logger.info(
-            f"Split sizes: {len(train_dataset)} train and {len(val_dataset)} validation.")
-
-        logger.warning(
-            f"Updated {len(text_updates)} transcript(s) using '{data_args.orthography}' orthography rules.")
-        if logger.isEnabledFor(logging.DEBUG):
-            for original_text, updated_text in text_updates:
-                logger.debug(
-                    f'Updated text: "{original_text}" -> "{updated_text}"')
-        text_updates = None
-
-        def prepare_dataset(batch):
-            # check that all files have the correct sampling rate
-            assert (
-                len(set(batch["sampling_rate"])) == 1
-            ), f"Make sure all inputs have the same sampling rate of {processor.feature_extractor.sampling_rate}."
+    if use_ft_vocab:
+        # Use fine-tuned model, don't remove LM head
+        if lang == "fi":
+            pretrained_fi = "/scratch/elec/puhe/p/getmany1/wav2vec2_large_14.2k_fi_donatespeech_100h_SEGMENTED_13042022_60ep/checkpoint-11100"
+            processor = Wav2Vec2Processor.from_pretrained(
+                pretrained_fi, cache_dir=model_args.cache_dir)
+        elif lang == "sv":
+            processor = Wav2Vec2Processor.from_pretrained(
+                model_args.model_name_or_path, cache_dir=model_args.cache_dir)
+
+    wer_metric = datasets.load_metric("wer")
+    cer_metric = datasets.load_metric("cer")
+
+    target_sr = processor.feature_extractor.sampling_rate if data_args.target_feature_extractor_sampling_rate else None
+    vocabulary_text_cleaner = make_vocabulary_text_cleaner(processor.tokenizer)
+
+    def prepare_example(batch):
+        # stored as 16-bit PCM, which is lossless for the WAV recordings and half the size of float32
+        batch["speech"] = [
+            (load_speech(file, 16000) * 32768.0).clip(-32768,
+                                                      32767).astype(np.int16)
+            for file in batch["file"]
+        ]
+        batch["sampling_rate"] = [16000] * len(batch["speech"])
+
+        batch["duration_in_seconds"] = [
+            len(speech) / target_sr for speech in batch["speech"]]
+        # keep the original so updates can be collected after a multi-process map
+        batch["original_text"] = batch["text"]
+        batch["text"] = [
+            vocabulary_text_cleaner(
+                orthography.preprocess_for_training(text))
+            for text in batch["text"]
+        ]
+        return batch
 
-            batch["input_values"] = processor(
-                batch["speech"], sampling_rate=batch["sampling_rate"][0]).input_values
+    def prepare_dataset(batch):
+        # check that all files have the correct sampling rate
+        assert (
+            set(batch["sampling_rate"]) == {
+                processor.feature_extractor.sampling_rate}
+        ), f"Make sure all inputs have the same sampling rate of {processor.feature_extractor.sampling_rate}."
 
-            with processor.as_target_processor():
-                batch["labels"] = processor(batch["text"]).input_ids
-            return batch
+        batch["labels"] = processor.tokenizer(
+            batch["text"], add_special_tokens=False).input_ids
+        return batch
 
-        train_dataset = train_dataset.map(
-            prepare_dataset,
+    def filter_by_max_duration(example):
+        return example["duration_in_seconds"] <= data_args.max_duration_in_seconds
+
+    def prepare_streaming_dataset(dataset, shuffle=False):
+        num_rows = len(dataset)
+        dataset = dataset.to_iterable_dataset(
+            num_shards=min(num_rows, max(training_args.dataloader_num_workers, 1)))
+        if shuffle:
+            # only the metadata is buffered at this point, so the buffer can hold the whole split
+            dataset = dataset.shuffle(
+                seed=training_args.seed, buffer_size=num_rows)
+        dataset = dataset.map(
+            prepare_example,
             batched=True,
             batch_size=training_args.per_device_train_batch_size,
-            num_proc=6,
+            remove_columns=["file"],
         )
-        val_dataset = val_dataset.map(
+        dataset = dataset.remove_columns("original_text")
+        if data_args.max_duration_in_seconds is not None:
+            dataset = dataset.filter(filter_by_max_duration)
+        dataset = dataset.map(
             prepare_dataset,
-            batch_size=training_args.per_device_train_batch_size,
             batched=True,
-            num_proc=data_args.preprocessing_num_workers,
+            batch_size=training_args.per_device_train_batch_size,
         )
+        return dataset.rename_column("speech", "input_values")
 
+    if training_args.world_size > 1 and not data_args.streaming and data_args.preprocessed_dataset_dir is None:
+        raise ValueError(
+            "`preprocessed_dataset_dir` is required when training with several processes, so that the dataset "
+            "preprocessed by the main process can be shared with the others."
+        )
+    preprocessing_args = {
+        "orthography": data_args.orthography,
+        "max_duration_in_seconds": data_args.max_duration_in_seconds,
+        "target_feature_extractor_sampling_rate": data_args.target_feature_extractor_sampling_rate,
+    }
+    preprocessing_args_file = pathlib.Path(
+        data_args.preprocessed_dataset_dir or "", "preprocessing_args.json")
+
+    # audio decoding and feature extraction do not depend on the fold, so they run once for the whole dataframe
+    with training_args.main_process_first(local=False, desc="dataset preprocessing"):
+        if data_args.streaming:
+            # only the metadata is loaded here, audio is decoded per fold by prepare_streaming_dataset
+            full_dataset = datasets.Dataset.from_pandas(df)
+        elif training_args.process_index != 0 or (
+            data_args.preprocessed_dataset_dir is not None
+            and pathlib.Path(data_args.preprocessed_dataset_dir).exists()
+            and not data_args.overwrite_cache
+        ):
+            # the other processes always reuse what the main process has just saved
+            full_dataset = datasets.load_from_disk(
+                data_args.preprocessed_dataset_dir)
+            if preprocessing_args_file.exists() and json.loads(preprocessing_args_file.read_text()) != preprocessing_args:
+                logger.warning(
+                    f"The dataset in {data_args.preprocessed_dataset_dir} was preprocessed with "
+                    f"{preprocessing_args_file.read_text()}, not {json.dumps(preprocessing_args)}. "
+                    "Pass --overwrite_cache to preprocess it again."
+                )
+        else:
+            full_dataset = datasets.Dataset.from_pandas(df)
+            full_dataset = full_dataset.map(
+                prepare_example,
+                batched=True,
+                batch_size=256,
+                remove_columns=["file"],
+                num_proc=data_args.preprocessing_num_workers or 8,
+                writer_batch_size=256,
+                load_from_cache_file=not data_args.overwrite_cache,
+            )
+            text_updates = [
+                (original_text, updated_text)
+                for original_text, updated_text in zip(full_dataset["original_text"], full_dataset["text"])
+                if original_text != updated_text
+            ]
+            full_dataset = full_dataset.remove_columns("original_text")
+            full_dataset = full_dataset.cast_column(
+                "speech", datasets.Sequence(datasets.Value("int16")))
+
+            logger.warning(
+                f"Updated {len(text_updates)} transcript(s) using '{data_args.orthography}' orthography rules.")
+            if logger.isEnabledFor(logging.DEBUG):
+                for original_text, updated_text in text_updates:
+                    logger.debug(
+                        f'Updated text: "{original_text}" -> "{updated_text}"')
+            text_updates = None
+
+            if data_args.max_duration_in_seconds is not None:
+                old_size = len(full_dataset)
+                full_dataset = full_dataset.filter(filter_by_max_duration)
+                if len(full_dataset) < old_size:
+                    logger.warning(
+                        f"Filtered out {old_size - len(full_dataset)} example(s) longer than {data_args.max_duration_in_seconds} second(s)."
+                    )
+
+            full_dataset = full_dataset.map(
+                prepare_dataset,
+                batched=True,
+                batch_size=training_args.per_device_train_batch_size,
+                num_proc=data_args.preprocessing_num_workers,
+                load_from_cache_file=not data_args.overwrite_cache,
+            )
+            # normalization is done by the data collator, so the raw waveform is the model input
+            full_dataset = full_dataset.rename_column("speech", "input_values")
+            if data_args.preprocessed_dataset_dir is not None:
+                full_dataset.save_to_disk(data_args.preprocessed_dataset_dir)
+                preprocessing_args_file.write_text(
+                    json.dumps(preprocessing_args))
+
+    if use_ft_vocab:
+        # Use fine-tuned model, don't remove LM head
+        model = Wav2Vec2ForCTC.from_pretrained(model_args.model_name_or_path, cache_dir=model_args.cache_dir,
+                                               pad_token_id=processor.tokenizer.pad_token_id, vocab_size=len(processor.tokenizer))
+    if training_args.ddp_find_unused_parameters is None and model.config.layerdrop == 0.0:
+        # with LayerDrop some layers are skipped in a step, so DDP has to look for unused parameters
+        training_args.ddp_find_unused_parameters = False
+    # every fold starts from the same weights, so keep a host copy instead of reloading the checkpoint
+    initial_state_dict = {}
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().clone()
+        initial_state_dict[name] = tensor.pin_memory() if torch.cuda.is_available() else tensor
+
+    # fold of every row, so that the splits are selected by index instead of scanning the dataset per fold
+    splits = np.asarray(full_dataset["split"])
+    max_steps = training_args.max_steps
+    if fold_rank is not None:
+        folds = [folds[fold_rank]]
+    for i in folds:
+        if is_main_process:
+            print(f"Fold {i}")
+
+        model.load_state_dict(initial_state_dict)
+        model.zero_grad(set_to_none=True)
+
+        train_dataset = full_dataset.select(np.flatnonzero(splits != i))
+        val_dataset = full_dataset.select(np.flatnonzero(splits == i))
+        logger.info(
+            f"Split sizes: {len(train_dataset)} train and {len(val_dataset)} validation.")
+        if data_args.streaming:
+            if max_steps <= 0:
+                # Trainer cannot infer the number of steps from an iterable dataset
+                steps_per_epoch = math.ceil(len(train_dataset) / (
+                    training_args.train_batch_size * training_args.world_size * training_args.gradient_accumulation_steps))
+                training_args.max_steps = math.ceil(
+                    training_args.num_train_epochs * steps_per_epoch)
+            train_dataset = prepare_streaming_dataset(
+                train_dataset, shuffle=True)
+            val_dataset = prepare_streaming_dataset(val_dataset)
+
+        # the encoder downsamples by 320, so padding to 320 * 8 samples keeps batch frame counts aligned to 8
         data_collator = DataCollatorCTCWithPadding(
-            processor=processor, padding=True)
+            processor=processor, padding="longest", pad_to_multiple_of=320 * 8, pad_to_multiple_of_labels=8)
 
         def compute_metrics(pred):
-            pred_logits = pred.predictions
-            pred_ids = np.argmax(pred_logits, axis=-1)
-
+            # already reduced to token ids by preprocess_logits_for_metrics
+            pred_ids = pred.predictions
+            pred_ids[pred_ids == -100] = processor.tokenizer.pad_token_id
             pred.label_ids[pred.label_ids == -
                            100] = processor.tokenizer.pad_token_id
 
@@ -487,26 +713,38 @@ def main():
         if model_args.freeze_base_model:
             model.freeze_base_model()
 
-        if i == 0:
-            training_args.output_dir = training_args.output_dir+"_fold_"+str(i)
-        else:
-            training_args.output_dir = training_args.output_dir.replace(
-                f"_fold_{str(i-1)}", f"_fold_{str(i)}")
-        print(f"Output folder: {training_args.output_dir}")
+        # replace the fold suffix of the previous fold (or of the command line) with the current one
+        training_args.output_dir = re.sub(
+            r"(_fold_\d+)?$", f"_fold_{i}", training_args.output_dir.rstrip("/"), count=1)
+        if is_main_process:
+            print(f"Output folder: {training_args.output_dir}")
         trainer = CTCTrainer(
             model=model,
             data_collator=data_collator,
             args=training_args,
             compute_metrics=compute_metrics,
+            preprocess_logits_for_metrics=preprocess_logits_for_metrics,
             train_dataset=train_dataset,
             eval_dataset=val_dataset,
             tokenizer=processor.feature_extractor,
         )
 
         trainer.train()
-        if training_args.load_best_model_at_end:
-            predictions = trainer.predict(val_dataset)
-            print(compute_metrics(predictions))
+        if training_args.do_predict:
+            metrics = trainer.predict(
+                val_dataset, metric_key_prefix="final").metrics
+            if is_main_process:
+                print(metrics)
+        elif training_args.load_best_model_at_end and is_main_process and trainer.state.best_model_checkpoint:
+            # the best checkpoint was already evaluated on the validation split during training
+            best_step = int(
+                trainer.state.best_model_checkpoint.rstrip("/").rsplit("-", 1)[-1])
+            best_eval_log = next(
+                (log for log in trainer.state.log_history if log.get("step") == best_step and "eval_wer" in log), None)
+            if best_eval_log is None:
+                best_eval_log = {"best": trainer.state.best_metric,
+                                 "checkpoint": trainer.state.best_model_checkpoint}
+            print(best_eval_log)
 
 
 if __name__ == "__main__":